@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
-import copy
+import functools
 import regex
+import sys
 import unittest
 
 from typing import Optional
@@ -11,23 +12,149 @@ import util
 from synchromesh import StreamingCSD
 
 
+@functools.cache
 def regex_not_containing(m):
     'Returns a regular expression for any string that does not contain m.'
-    options = []
+    # Unrolled form of (normal|special)*, i.e. normal*(special normal*)*,
+    # so that runs of ordinary characters are consumed by a single class
+    # loop instead of retrying the whole alternation at every character.
+    escaped = [regex.escape(c) for c in m]
+    normal = f'[^{escaped[0]}]'
+    special = []
 
-    for i in range(len(m)):
-        options.append(f'{regex.escape(m[:i])}[^{regex.escape(m[i])}]')
-    return f'({"|".join(options)})*'
+    for i in range(1, len(m)):
+        special.append(f'{"".join(escaped[:i])}[^{escaped[i]}]')
+
+    if not special:
+        return f'{normal}*'
+
+    return f'{normal}*(?:(?:{"|".join(special)}){normal}*)*'
+
+
+def _trie_regex(strings: list[str]) -> str:
+    '''Returns a regular expression matching exactly the given strings, with
+    common prefixes factored out (e.g. ab|ac becomes a(?:b|c)).'''
+    trie = {}
+
+    for s in strings:
+        node = trie
+        for c in s:
+            node = node.setdefault(c, {})
+        # The empty key marks the end of a string.
+        node[''] = {}
+
+    return _trie_node_regex(trie)
+
+
+def _trie_node_regex(node: dict) -> str:
+    branches = [regex.escape(c) + _trie_node_regex(child)
+                for c, child in node.items() if c]
+
+    if not branches:
+        return ''
+
+    if len(branches) == 1 and '' not in node:
+        return branches[0]
+
+    alternation = f'(?:{"|".join(branches)})'
+
+    # A string ends here, so the rest is optional.
+    if '' in node:
+        return alternation + '?'
+
+    return alternation
 
 
 def _split_block(b: str) -> (str, str):
-    colon = b.index(':')
-    return (b[:colon], b[colon+1:])
+    keyword, _, content = b.partition(':')
+    return (keyword, content)
+
+
+@functools.lru_cache(maxsize=8)
+def _freeform_proposition_regex(is_goal: bool, end_marker: str) -> regex.Regex:
+    'Regex for any well-formed proposition, followed by the (escaped) end marker.'
+    atom_regex = '([a-zA-Z0-9-_]{1,50})'
+    param_regex = '(\'[a-z])'
+
+    if is_goal:
+        argument_regex = atom_regex
+    else:
+        argument_regex = f'({param_regex}|{atom_regex})'
+
+    term_regex = rf'({argument_regex}|(\({atom_regex}( {argument_regex}){{1,2}}\)))'
+    positive_property = rf'(\({atom_regex}( {term_regex}){{1,2}}\))'
+    proposition = rf'({positive_property}|(\(not {positive_property}\)))'
+
+    if is_goal:
+        return regex.compile(proposition + end_marker)
+
+    return regex.compile(f'{proposition}( -> ({proposition}))*{end_marker}')
+
+
+@functools.lru_cache(maxsize=512)
+def _infer_regex(choices: frozenset[str], end_marker: str) -> regex.Regex:
+    'Regex for any of the given inferences, followed by the end marker.'
+    # Choices share long prefixes (e.g. '(not (' or '(wumpus '), so
+    # factor them out instead of trying each alternative in turn.
+    return regex.compile(f'(?:{_trie_regex(sorted(choices))}){end_marker}')
+
+
+# Keyed on the declared objects and props, which only grow while a
+# theory is being formalized, so consecutive calls mostly hit.
+@functools.lru_cache(maxsize=512)
+def _proposition_regex(objects: tuple[str, ...], props: tuple[str, ...],
+                       is_goal: bool, end_marker: str) -> regex.Regex:
+    'Regex for propositions over the given objects and props.'
+    premises, conclusions = [], []
+
+    for p in props:
+        for o in objects + ("'x",):
+            positive_prop = f'({p} {o})'
+            negative_prop = f'(not ({p} {o}))'
+
+            premises.append(positive_prop)
+            premises.append(negative_prop)
+
+            if not o.startswith("'"):
+                conclusions.append(positive_prop)
+                conclusions.append(negative_prop)
+
+    if not premises:
+        assert False, 'Empty theory'
+
+    # Every proposition starts with '(' and most share a '(not (p ' or
+    # '(p ' prefix, so a trie keeps the engine from retrying each
+    # alternative from scratch on every token.
+    all_premises = _trie_regex(premises)
+
+    if conclusions:
+        all_conclusions = _trie_regex(conclusions)
+    else:
+        # A regex for the empty formal language.
+        all_conclusions = '$.'
+
+    if is_goal:
+        return regex.compile(f'({all_conclusions}){end_marker}')
+
+    return regex.compile(f'(({all_conclusions})|' +
+                         f'(({all_premises}) -> )+({all_premises}))' +
+                         end_marker)
 
 
 # Error when nothing to infer
 INFER_ERROR = 'nothing'
 
+# Maximum number of entries in each of the per-engine caches, which are kept
+# across problems when an engine is reused.
+ENGINE_CACHE_SIZE = 256
+
+
+def _cache_put(cache: dict, key, value):
+    'Stores the value, evicting the oldest entry once the cache is full.'
+    if len(cache) >= ENGINE_CACHE_SIZE:
+        del cache[next(iter(cache))]
+    cache[key] = value
+
 
 class PeanoCompletionEngine:
     '''CSD completion engine backed by a Peano domain.'''
@@ -42,32 +169,69 @@ class PeanoCompletionEngine:
         self.infer_atoms = infer_atoms
         self.done_when_exhausted = done_when_exhausted
 
+        # Actions available in the start derivation, to which the engine
+        # always allows applying.
+        self._initial_actions = frozenset(
+            domain.derivation_actions(start_derivation.universe) +
+            domain.tactic_actions())
+
+        self._start_marker_len = len(start_marker)
+        self._start_marker_escaped = regex.escape(start_marker)
+        self._end_marker_escaped = end_marker = regex.escape(end_marker)
+
+        # Patterns that do not depend on the prefix are compiled only once.
+        self._no_block_regex = regex.compile(regex_not_containing(start_marker) +
+                                             self._start_marker_escaped)
+        self._atom_regex = regex.compile('[a-zA-Z0-9-_]{1,50}' + end_marker)
+        self._var_regex = regex.compile('[a-z0-9-_]{1,50}' + end_marker)
+        self._eq_regex = regex.compile('[\\(\\)a-zA-Z0-9\\-=+\\*/ ]+' + end_marker)
+        # Block keyword patterns, keyed by the tuple of allowed keywords.
+        self._keywords_regex = {}
+        # Scanning state of the last prefix passed to get_verified_blocks:
+        # (prefix, unique blocks in order of appearance, contents of those
+        # blocks grouped by block type, position to resume from). The blocks
+        # are the keys of a dict, which deduplicates them while preserving
+        # insertion order.
+        # Prefixes grow one token at a time during decoding, so usually only
+        # the new suffix needs to be scanned.
+        self._blocks_cache = ('', {}, {}, 0)
+        # Fast-forwarded states, keyed by the tuple of verified blocks they
+        # replay: (universe, inferred arities, axiom names, goal).
+        self._ff_cache = {}
+        # Patterns returned for infer blocks, keyed by the tuple of verified
+        # blocks preceding them.
+        self._infer_cache = {}
+        # Results of is_complete, keyed by the tuple of verified blocks.
+        self._done_cache = {}
+
     def _get_open_block(self, prefix: str) -> Optional[str]:
-        # Find last occurrence of start and end markers.
+        # Find last occurrence of the start marker.
         last_start = prefix.rfind(self.start_marker)
-        last_end = prefix.rfind(self.end_marker)
 
-        # No start marker yet, or has both but last block was already closed.
-        if last_start == -1 or (last_end != -1 and
-                                last_end > last_start):
+        # No start marker yet.
+        if last_start == -1:
+            return None
+
+        # Last block was already closed. Only the text after the last start
+        # marker needs to be searched, rather than the whole prefix again.
+        if prefix.find(self.end_marker, last_start + 1) != -1:
             return None
 
         # Otherwise, last open block is still open.
-        return prefix[last_start + len(self.start_marker):]
+        return prefix[last_start + self._start_marker_len:]
 
     def complete(self, prefix: str):
         b = self._get_open_block(prefix)
-        end_marker = regex.escape(self.end_marker)
+        end_marker = self._end_marker_escaped
 
         if b is None:
             # Match anything not containing the start marker, followed
             # by the start marker.
-            return regex.compile(regex_not_containing(self.start_marker) +
-                                 regex.escape(self.start_marker))
+            return self._no_block_regex
 
         if not b:
             # The block was just open: return the supported keywords.
-            previous_blocks = {b for b, _ in self.get_verified_blocks(prefix)}
+            previous_blocks = self._scan_blocks(prefix)[1]
             allowed_next = ['prop', 'object', 'var', 'relation', 'axiom']
 
             if self.infer_atoms or \
@@ -78,134 +242,133 @@ class PeanoCompletionEngine:
             if 'var' in previous_blocks:
                 allowed_next.append('eq')
 
-            block_keywords = f'({"|".join(allowed_next)}):'
-            return regex.compile(block_keywords)
+            allowed_next = tuple(allowed_next)
+            keywords_regex = self._keywords_regex.get(allowed_next)
+
+            if keywords_regex is None:
+                keywords_regex = regex.compile(f'({"|".join(allowed_next)}):')
+                self._keywords_regex[allowed_next] = keywords_regex
+
+            return keywords_regex
 
         block_keyword, block_contents = _split_block(b)
         assert not block_contents
 
         if block_keyword in ('prop', 'object', 'relation'):
-            return regex.compile('[a-zA-Z0-9-_]{1,50}' + end_marker)
+            return self._atom_regex
 
         if block_keyword == 'var':
-            return regex.compile('[a-z0-9-_]{1,50}' + end_marker)
+            return self._var_regex
 
         if block_keyword == 'eq':
-            return regex.compile('[\\(\\)a-zA-Z0-9\\-=+\\*/ ]+' + end_marker)
+            return self._eq_regex
 
         if block_keyword in ('axiom', 'goal'):
             if self.infer_atoms:
                 return self._make_freeform_proposition_regex(block_keyword == 'goal')
 
-            previous_blocks = self.get_verified_blocks(prefix)
-            return self._make_proposition_regex(previous_blocks,
+            _, blocks_by_type = self._scan_blocks(prefix)
+            return self._make_proposition_regex(blocks_by_type,
                                                 block_keyword == 'goal')
 
-        regex.compile(regex_not_containing(self.end_marker) +
-                      end_marker)
-
         if block_keyword == 'infer':
             # Match any of the actions followed by the end marker.
-            verified_blocks = self.get_verified_blocks(prefix)
-            ff_derivation = self.fast_forward_derivation(verified_blocks)
-            choices = self.enumerate_choices(ff_derivation.universe)
+            verified_blocks, blocks_by_type = self._scan_blocks(prefix)
 
-            # Filter duplicate inferences.
-            new_choices = []
-            for c in choices:
-                inference = self.format_fn(c.clean_dtype(ff_derivation.universe))
-                is_new = True
-
-                for keyword, content in verified_blocks:
-                    if keyword == 'infer' and content == inference:
-                        is_new = False
-                        break
+            # The choices only depend on the verified blocks, which do not
+            # change while the infer block is being decoded.
+            key = tuple(verified_blocks)
+            infer_regex = self._infer_cache.get(key)
 
-                if is_new:
-                    new_choices.append(inference)
+            if infer_regex is not None:
+                return infer_regex
 
-            if not new_choices:
-                new_choices = [INFER_ERROR]
+            universe, _, axiom_names, _ = self._fast_forward(key)
+            choices = self.enumerate_choices(universe, axiom_names)
 
-            out = '|'.join(map(regex.escape, new_choices))
+            # Filter duplicate inferences.
+            prior_inferences = set(blocks_by_type.get('infer', ()))
+            format_fn = self.format_fn
+            inferences = (format_fn(c.clean_dtype(universe)) for c in choices)
+            new_choices = frozenset(inference for inference in inferences
+                                    if inference not in prior_inferences)
 
-            return regex.compile(f'({out}){end_marker}')
+            infer_regex = _infer_regex(new_choices or frozenset([INFER_ERROR]),
+                                       end_marker)
 
-        raise ValueError(f'Invalid block type {block_keyword}.')
+            _cache_put(self._infer_cache, key, infer_regex)
 
-    def _make_freeform_proposition_regex(self, is_goal: bool) -> regex.Regex:
-        atom_regex = '([a-zA-Z0-9-_]{1,50})'
-        param_regex = '(\'[a-z])'
+            return infer_regex
 
-        if is_goal:
-            argument_regex = atom_regex
-        else:
-            argument_regex = f'({param_regex}|{atom_regex})'
-
-        term_regex = rf'({argument_regex}|(\({atom_regex}( {argument_regex}){{1,2}}\)))'
-        positive_property = rf'(\({atom_regex}( {term_regex}){{1,2}}\))'
-        proposition = rf'({positive_property}|(\(not {positive_property}\)))'
-
-        if is_goal:
-            return regex.compile(proposition + regex.escape(self.end_marker))
+        raise ValueError(f'Invalid block type {block_keyword}.')
 
-        return regex.compile(f'{proposition}( -> ({proposition}))*{regex.escape(self.end_marker)}')
+    def _make_freeform_proposition_regex(self, is_goal: bool) -> regex.Regex:
+        return _freeform_proposition_regex(is_goal, self._end_marker_escaped)
 
     def _make_proposition_regex(self,
-                                previous_blocks: list[tuple[str, str]],
+                                blocks_by_type: dict[str, list[str]],
                                 is_goal: bool) -> regex.Regex:
-        objects = [v for k, v in previous_blocks if k == 'object']
-        props = [v for k, v in previous_blocks if k == 'prop']
-
-        premises, conclusions = [], []
-
-        for p in props:
-            for o in objects + ["'x"]:
-                positive_prop = f'({p} {o})'
-                negative_prop = f'(not ({p} {o}))'
-
-                premises.append(positive_prop)
-                premises.append(negative_prop)
-
-                if not o.startswith("'"):
-                    conclusions.append(positive_prop)
-                    conclusions.append(negative_prop)
+        objects = tuple(blocks_by_type.get('object', ()))
+        props = tuple(blocks_by_type.get('prop', ()))
 
-        all_premises = '|'.join(map(regex.escape, premises))
-        all_conclusions = '|'.join(map(regex.escape, conclusions))
+        return _proposition_regex(objects, props, is_goal,
+                                  self._end_marker_escaped)
 
-        if not all_conclusions:
-            # A regex for the empty formal language.
-            all_conclusions = '$.'
 
-        if not all_premises:
-            assert False, 'Empty theory'
-
-        end_marker = regex.escape(self.end_marker)
-
-        if is_goal:
-            return regex.compile(f'({all_conclusions}){end_marker}')
-
-        return regex.compile(f'(({all_conclusions})|' +
-                             f'(({all_premises}) -> )+({all_premises}))' +
-                             end_marker)
+    def fast_forward_derivation(self, verified_blocks: list[tuple[str, str]]):
+        u, _, _, goal = self._fast_forward(tuple(verified_blocks))
+        # The cached universe is shared by the whole engine, so callers get
+        # their own copy to extend.
+        return self._make_problem(u.clone(), goal)
+
+    def _make_problem(self, universe, goal: Optional[str]) -> domain.Problem:
+        # Building the Problem directly is cheaper than copy.copy, which goes
+        # through the generic __reduce_ex__ protocol.
+        return domain.Problem(universe, self.start_derivation.description, goal,
+                              self.start_derivation.domain)
+
+    def _fast_forward(self, key: tuple[tuple[str, str], ...]):
+        '''Replays the blocks, returning the cached state (universe, inferred
+        arities, names of the incorporated axioms, goal). None of these should
+        be modified.'''
+        # Resume from the longest prefix of these blocks that was already
+        # replayed, so that each new block is only incorporated once.
+        n = len(key)
+        while n > 0 and key[:n] not in self._ff_cache:
+            n -= 1
+
+        if key[:n] in self._ff_cache:
+            u, arities, axiom_names, goal = self._ff_cache[key[:n]]
+
+            # The cached universe is shared: only extend a copy of it.
+            if n < len(key):
+                u, arities, axiom_names = u.clone(), dict(arities), set(axiom_names)
+        else:
+            u = self.start_derivation.universe.clone()
 
+            u.incorporate('object : type. not : [prop -> prop].')
+            arities = {}
+            axiom_names = set()
 
-    def fast_forward_derivation(self, verified_blocks: list[tuple[str, str]]):
-        u = self.start_derivation.universe.clone()
+            goal = None
 
-        u.incorporate('object : type. not : [prop -> prop].')
-        arities = {}
+        # Declarations are parsed in batches by a single incorporate call,
+        # which only needs to happen before an inference is replayed.
+        declarations = []
+        declare = declarations.append
 
-        goal = None
+        def flush():
+            if declarations:
+                u.incorporate(' '.join(declarations))
+                declarations.clear()
 
-        for i, (block_type, block_content) in enumerate(verified_blocks):
+        for i, (block_type, block_content) in enumerate(key[n:], n):
             if block_type == 'prop':
                 if not self.infer_atoms:
-                    u.incorporate(f'{block_content} : [object -> prop].')
+                    declare(f'{block_content} : [object -> prop].')
             elif block_type == 'relation':
                 if not self.infer_atoms:
-                    u.incorporate(f'{block_content} : [object -> object -> prop].')
+                    declare(f'{block_content} : [object -> object -> prop].')
             elif block_type == 'axiom':
                 if self.infer_atoms:
                     # Infer arities and declare new things.
@@ -219,10 +382,10 @@ class PeanoCompletionEngine:
                                 arities[k] = v
 
                                 if v == 0:
-                                    u.incorporate(f'let {k} : object.')
+                                    declare(f'let {k} : object.')
                                 else:
                                     rtype = 'prop' if k == toplevel else 'object'
-                                    u.incorporate(f'{k} : [{" -> ".join(["object"] * v)} -> {rtype}].')
+                                    declare(f'{k} : [{" -> ".join(["object"] * v)} -> {rtype}].')
                             elif v != arities[k]:
                                 ignore = True
                                 break
@@ -236,22 +399,27 @@ class PeanoCompletionEngine:
                 if block_content.find('->') != -1:
                     block_content = f'[{block_content}]'
 
-                u.incorporate(f'axiom{i} : {block_content}.')
+                declare(f'axiom{i} : {block_content}.')
+                axiom_names.add(f'axiom{i}')
             elif block_type == 'object':
                 if not self.infer_atoms:
-                    u.incorporate(f'let {block_content} : object.')
+                    declare(f'let {block_content} : object.')
             elif block_type == 'goal':
                 goal = block_content
             elif block_type == 'var':
-                u.incorporate(f'let {block_content} : real.')
+                declare(f'let {block_content} : real.')
             elif block_type == 'eq':
-                u.incorporate(f'eq{i} : {util.format_infix(block_content)}.')
+                declare(f'eq{i} : {util.format_infix(block_content)}.')
             elif block_type == 'infer':
-                choices = self.enumerate_choices(u)
+                # Replaying needs the universe to be up to date.
+                flush()
+
+                choices = self.enumerate_choices(u, axiom_names)
+                format_fn, value_of = self.format_fn, self.domain.value_of
 
                 found = False
                 for c in choices:
-                    if self.format_fn(self.domain.value_of(u, c)) == block_content:
+                    if format_fn(value_of(u, c)) == block_content:
                         # Found the choice made at this step.
                         found = True
                         self.domain.define(u, f'!step{i}', c)
@@ -262,80 +430,122 @@ class PeanoCompletionEngine:
             else:
                 raise ValueError(f'Invalid block type {block_type}')
 
-        d_prime = copy.copy(self.start_derivation)
-        d_prime.universe = u
-        d_prime.goal = goal
+        flush()
 
-        return d_prime
+        if key not in self._ff_cache:
+            _cache_put(self._ff_cache, key, (u, arities, axiom_names, goal))
 
+        return u, arities, axiom_names, goal
 
-    def enumerate_choices(self, universe):
-        initial_actions = set(self.domain.derivation_actions(self.start_derivation.universe) +
-                              self.domain.tactic_actions())
-        arrows = set(self.domain.derivation_actions(universe)).union(initial_actions)
+
+    def enumerate_choices(self, universe, axiom_names: Optional[set[str]] = None):
+        '''Returns the choices available in the universe. `axiom_names` are
+        the axioms that can be applied; if not given, they are found among the
+        universe's actions by name.'''
+        initial_actions, apply = self._initial_actions, self.domain.apply
+        arrows = initial_actions.union(self.domain.derivation_actions(universe))
+
+        if axiom_names is None:
+            axiom_names = {a for a in arrows if regex.fullmatch('axiom\\d+', a)}
 
         choices = []
 
         for a in arrows:
-            if a in initial_actions or regex.fullmatch('axiom\\d+', a):
-                choices.extend(self.domain.apply(a, universe))
+            if a in initial_actions or a in axiom_names:
+                choices.extend(apply(a, universe))
 
         return choices
 
     def get_verified_blocks(self, prefix: str) -> list[tuple[str, str]]:
-        blocks, i = [], None
+        return list(self._scan_blocks(prefix)[0])
+
+    def _scan_blocks(self, prefix: str):
+        '''Returns the unique blocks in the prefix (as dict keys, in order),
+        and their contents grouped by block type. Both are cached, and should
+        not be modified.'''
+        cached_prefix, unique_blocks, blocks_by_type, i = self._blocks_cache
+
+        if not prefix.startswith(cached_prefix):
+            unique_blocks, blocks_by_type, i = {}, {}, 0
+
+        find, start_marker, end_marker = prefix.find, self.start_marker, self.end_marker
+        start_len = self._start_marker_len
 
         while True:
-            i = prefix.find(self.start_marker, i)
-            if i != -1:
-                j = prefix.find(self.end_marker, i)
-                if j != -1:
-                    blocks.append(
-                        _split_block(prefix[i + len(self.start_marker):j]))
-                    i = j + 1
-                else:
-                    break
-            else:
+            start = find(start_marker, i)
+            if start == -1:
+                break
+
+            end = find(end_marker, start)
+            if end == -1:
                 break
 
-        seen_blocks = set()
-        unique_blocks = []
+            # Inlined _split_block.
+            keyword, _, content = prefix[start + start_len:end].partition(':')
+            b = (keyword, content)
 
-        for b in blocks:
-            if b not in seen_blocks:
-                seen_blocks.add(b)
-                unique_blocks.append(b)
+            if b not in unique_blocks:
+                # Interned so that cache keys built from the blocks compare
+                # by identity when the same block is seen again.
+                b = (sys.intern(keyword), sys.intern(content))
+                unique_blocks[b] = None
+                blocks_by_type.setdefault(b[0], []).append(b[1])
 
-        return unique_blocks
+            i = end + 1
+
+        self._blocks_cache = (prefix, unique_blocks, blocks_by_type, i)
+
+        return unique_blocks, blocks_by_type
 
     def is_complete(self, prefix: str) -> bool:
-        blocks = self.get_verified_blocks(prefix)
+        blocks = tuple(self._scan_blocks(prefix)[0])
+
+        # The answer only depends on the verified blocks, and the decoder
+        # asks again after every token while these stay the same.
+        # The result may be None, so membership is checked explicitly.
+        if blocks in self._done_cache:
+            return self._done_cache[blocks]
+
+        done = self._derivation_done(blocks)
 
+        _cache_put(self._done_cache, blocks, done)
+
+        return done
+
+    def _derivation_done(self, blocks: tuple[tuple[str, str], ...]):
         # If exhausted inferences, it is done.
-        if INFER_ERROR in [v for k, v in blocks]:
+        if any(v == INFER_ERROR for _, v in blocks):
             if self.done_when_exhausted:
                 return True, False
 
             return None, False
 
-        ff = self.fast_forward_derivation(blocks)
-        return self.domain.derivation_done(ff)
+        # derivation_done only reads the universe, so the cached one is used
+        # without copying it.
+        u, _, _, goal = self._fast_forward(blocks)
+        return self.domain.derivation_done(self._make_problem(u, goal))
 
 
 def infer_sexp_arities(sexp: list, result: dict[str, int]):
-    if isinstance(sexp, str):
-        if result.setdefault(sexp, 0) != 0:
-            raise ValueError(f'Conflicting arities for {sexp}.')
-    else:
-        fn = sexp[0]
-        arity = len(sexp) - 1
+    # Walks the s-expression with an explicit stack, in the same pre-order
+    # as a recursive walk, so arities are inserted in the same order.
+    stack = [sexp]
+
+    while stack:
+        sexp = stack.pop()
 
-        if fn != 'not':
-            if result.setdefault(fn, arity) != arity:
-                raise ValueError(f'Conflicting arities for {fn}.')
+        if isinstance(sexp, str):
+            if result.setdefault(sexp, 0) != 0:
+                raise ValueError(f'Conflicting arities for {sexp}.')
+        else:
+            fn = sexp[0]
+            arity = len(sexp) - 1
+
+            if fn != 'not':
+                if result.setdefault(fn, arity) != arity:
+                    raise ValueError(f'Conflicting arities for {fn}.')
 
-        for subexpr in sexp[1:]:
-            infer_sexp_arities(subexpr, result)
+            stack.extend(reversed(sexp[1:]))
 
 
 def infer_arities(rule: str) -> dict[str, int]:
@@ -349,12 +559,47 @@ def infer_arities(rule: str) -> dict[str, int]:
     return result, toplevel
 
 
+@functools.cache
+def _get_tokenizer_and_vocab(name: str):
+    'Loads a tokenizer and its decoded vocabulary once for all tests.'
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(name, use_fast=True)
+
+    vocab = tokenizer.batch_decode([[i] for i in range(tokenizer.vocab_size)])
+
+    return tokenizer, vocab
+
+
+@functools.cache
+def _encoded(text: str, add_special_tokens: bool = True,
+             name: str = "facebook/opt-13b") -> tuple[int, ...]:
+    'Token ids of the text, computed once per session.'
+    tokenizer = _get_tokenizer_and_vocab(name)[0]
+    return tuple(tokenizer.encode(text, add_special_tokens=add_special_tokens))
+
+
 class PeanoCompletionEngineTest(unittest.TestCase):
-    def test_fol_completions(self):
-        d = domain.FirstOrderLogicDomain()
-        prob = d.start_derivation()
+    @classmethod
+    def setUpClass(cls):
+        # Loading the theory is the expensive part of building the domain.
+        # Each engine starts from its own clone of the base derivation, so
+        # tests can share the domain itself.
+        cls.fol_domain = domain.FirstOrderLogicDomain()
+
+    def _fol_engine(self, **kwargs) -> PeanoCompletionEngine:
+        d = self.fol_domain
+        return PeanoCompletionEngine(d, d.start_derivation(), **kwargs)
+
+    def _feed_tokens(self, csd, tokens: tuple[int, ...]):
+        'Feeds the tokens to the CSD, checking that each one is allowed.'
+        can_token_follow, feed_prediction = csd.can_token_follow, csd.feed_prediction
 
-        ce = PeanoCompletionEngine(d, prob)
+        for i, t in enumerate(tokens):
+            assert can_token_follow(t), f'Token #{i} ({t}) was rejected.'
+            feed_prediction(t)
+
+    def test_fol_completions(self):
+        ce = self._fol_engine()
 
         p1 = '''
 1- Vumpuses are zumpuses. 2- Each zumpus is a rompus. 3- Every tumpus is small. 4- Each impus is a tumpus. 5- Each rompus is a jompus. 6- Tumpuses are wumpuses. 7- Every yumpus is transparent. 8- Yumpuses are numpuses. 9- Zumpuses are orange. 10- Jompuses are yumpuses. 11- Rompuses are floral. 12- Wumpuses are vumpuses. 13- Every wumpus is nervous. 14- Every impus is temperate. 15- Jompuses are not sweet. 16- Dumpuses are not floral. 17- Every vumpus is angry. 18- Sally is a tumpus.
@@ -400,10 +645,7 @@ Reasoning: [[infer:(wumpus sally)]] Sally is a wumpus. [[infer:(vumpus sally)]]
 
 
     def test_axiom_constraints(self):
-        d = domain.FirstOrderLogicDomain()
-        prob = d.start_derivation()
-
-        ce = PeanoCompletionEngine(d, prob, infer_atoms=False)
+        ce = self._fol_engine(infer_atoms=False)
 
         p1 = '''
 1- Vumpuses are zumpuses. 2- Each zumpus is a rompus. 3- Every tumpus is small. 4- Each impus is a tumpus. 5- Each rompus is a jompus. 6- Tumpuses are wumpuses. 7- Every yumpus is transparent. 8- Yumpuses are numpuses. 9- Zumpuses are orange. 10- Jompuses are yumpuses. 11- Rompuses are floral. 12- Wumpuses are vumpuses. 13- Every wumpus is nervous. 14- Every impus is temperate. 15- Jompuses are not sweet. 16- Dumpuses are not floral. 17- Every vumpus is angry. 18- Sally is a tumpus.
@@ -443,19 +685,14 @@ Formalized context: 1- [[prop:vumpus]] are [[prop:zumpus]]. [[axiom:(vumpus 'x)
 Formalized goal: [[goal:(carnivorous stella)]]
 Reasoning: [[infer:(carnivore cats)]] Cats are carnivores. [[infer:(carnivorous cats)]] Cats are carnivorous. [[infer:(mammal cats)]] Cats are mammals. [[infer:(vertebrate cats)]] Cats are vertebrates. [[infer:(animal cats)]] Cats are animals. [[infer:(not (unicellular cats))]] Cats are not unicellular. [[infer:(furry cats)]] Cats are furry. [[infer:"""
 
-        d = domain.FirstOrderLogicDomain()
-        prob = d.start_derivation()
-        ce = PeanoCompletionEngine(d, prob)
+        ce = self._fol_engine()
 
         a = ce.complete(prefix)
         self.assertTrue(a.match(INFER_ERROR, partial=True))
 
 
     def test_avoid_duplicates(self):
-        d = domain.FirstOrderLogicDomain()
-        prob = d.start_derivation()
-
-        ce = PeanoCompletionEngine(d, prob)
+        ce = self._fol_engine()
 
         prefix = '''
 Context: 1- Vumpuses are zumpuses. 2- Each zumpus is a rompus. 3- Every tumpus is small. 4- Each impus is a tumpus. 5- Each rompus is a jompus. 6- Tumpuses are wumpuses. 7- Every yumpus is transparent. 8- Yumpuses are numpuses. 9- Zumpuses are orange. 10- Jompuses are yumpuses. 11- Rompuses are floral. 12- Wumpuses are vumpuses. 13- Every wumpus is nervous. 14- Every impus is temperate. 15- Jompuses are not sweet. 16- Dumpuses are not floral. 17- Every vumpus is angry. 18- Sally is a tumpus.
@@ -468,6 +705,142 @@ Reasoning: [[infer:(wumpus sally)]] Sally is a wumpus. [[infer:'''
         # Duplicate
         self.assertFalse(ce.complete(prefix).match('(wumpus sally)]]'))
 
+    def test_underivable_goal_inference(self):
+        prefix = '''Formalized context: 1- [[prop:tumpus]] are [[prop:wumpus]]. [[axiom:(tumpus 'x) -> (wumpus 'x)]]. 2- [[object:sally]] is a [[prop:tumpus]]. [[axiom:(tumpus sally)]].
+Formalized goal: [[goal:(floral sally)]]
+Reasoning: [[infer:'''
+        solution = prefix + '(floral sally)]] Sally is floral. This was the goal.'
+
+        # The last inference is the goal, but does not follow from the axioms.
+        ce = self._fol_engine()
+        self.assertFalse(ce.complete(prefix).match('(floral sally)]]'))
+        with self.assertRaises(AssertionError):
+            ce.is_complete(solution)
+
+        # Same without first asking for completions.
+        with self.assertRaises(AssertionError):
+            self._fol_engine().is_complete(solution)
+
+    def test_goal_as_last_inference(self):
+        prefix = '''Formalized context: 1- [[prop:tumpus]] are [[prop:wumpus]]. [[axiom:(tumpus 'x) -> (wumpus 'x)]]. 2- [[object:sally]] is a [[prop:tumpus]]. [[axiom:(tumpus sally)]].
+Formalized goal: [[goal:(wumpus sally)]]
+Reasoning: [[infer:'''
+        solution = prefix + '(wumpus sally)]] Sally is a wumpus. This was the goal.'
+
+        ce = self._fol_engine()
+        self.assertTrue(ce.complete(prefix).match('(wumpus sally)]]'))
+
+        replay = self._fol_engine()
+        ff = replay.fast_forward_derivation(replay.get_verified_blocks(solution))
+        expected = self.fol_domain.derivation_done(ff)
+
+        self.assertEqual(expected, ('!step6', True))
+        self.assertEqual(ce.is_complete(solution), expected)
+
+    def test_fast_forward_returns_copy(self):
+        prefix = '''Formalized context: 1- [[prop:tumpus]] are [[prop:wumpus]]. [[axiom:(tumpus 'x) -> (wumpus 'x)]]. 2- [[object:sally]] is a [[prop:tumpus]]. [[axiom:(tumpus sally)]].
+Formalized goal: [[goal:(wumpus sally)]]
+Reasoning: '''
+
+        ce = self._fol_engine()
+
+        # Extending the returned universe must not leak into the replay
+        # states the engine keeps.
+        ff = ce.fast_forward_derivation(ce.get_verified_blocks(prefix))
+        ff.universe.incorporate('axiom99 : (wumpus sally).')
+        self.assertEqual(self.fol_domain.derivation_done(ff), ('axiom99', True))
+
+        self.assertIsNone(ce.is_complete(prefix))
+        self.assertEqual(ce.is_complete(prefix + '[[infer:(wumpus sally)]]'),
+                         ('!step6', True))
+
+    def test_goal_already_inferred(self):
+        prefix = '''Formalized context: 1- [[prop:tumpus]] are [[prop:wumpus]]. [[axiom:(tumpus 'x) -> (wumpus 'x)]]. 2- [[prop:tumpus]] are not [[prop:wumpus]]. [[axiom:(tumpus 'x) -> (not (wumpus 'x))]]. 3- [[object:sally]] is a [[prop:tumpus]]. [[axiom:(tumpus sally)]].
+Formalized goal: [[goal:(wumpus sally)]]
+Reasoning: [[infer:(wumpus sally)]] Sally is a wumpus. [[infer:'''
+        solution = prefix + '(not (wumpus sally))]] Sally is not a wumpus.'
+
+        ce = self._fol_engine()
+        self.assertTrue(ce.complete(prefix).match('(not (wumpus sally))]]'))
+
+        # An earlier step already settled the goal, so the answer must be the
+        # one found by replaying the whole derivation, not the last step.
+        replay = self._fol_engine()
+        ff = replay.fast_forward_derivation(replay.get_verified_blocks(solution))
+
+        self.assertEqual(ce.is_complete(solution),
+                         self.fol_domain.derivation_done(ff))
+
+    def test_repeated_is_complete(self):
+        prefix = '''Formalized context: 1- [[prop:tumpus]] are [[prop:wumpus]]. [[axiom:(tumpus 'x) -> (wumpus 'x)]]. 2- [[object:sally]] is a [[prop:tumpus]]. [[axiom:(tumpus sally)]].
+Formalized goal: [[goal:(wumpus sally)]]
+Reasoning: '''
+        solution = prefix + '[[infer:(wumpus sally)]] Sally is a wumpus.'
+
+        ce = self._fol_engine()
+
+        # Results are memoized by the verified blocks, including None.
+        for _ in range(2):
+            self.assertIsNone(ce.is_complete(prefix))
+            self.assertIsNone(ce.is_complete(prefix + 'Sally'))
+
+        for _ in range(2):
+            self.assertEqual(ce.is_complete(solution), ('!step6', True))
+            self.assertEqual(ce.is_complete(solution + ' This was the goal.'),
+                             ('!step6', True))
+
+        # Going back to an earlier prefix still gives its own result.
+        self.assertIsNone(ce.is_complete(prefix))
+
+    def test_incremental_block_scan(self):
+        ce = self._fol_engine()
+
+        # A block left open (or half closed) is only picked up once closed.
+        p = "[[prop:vumpus]] are [[prop:zumpus]]. [[axiom:(vumpus 'x"
+        self.assertEqual(ce.get_verified_blocks(p),
+                         [('prop', 'vumpus'), ('prop', 'zumpus')])
+        p += ") -> (zumpus 'x)]"
+        self.assertEqual(len(ce.get_verified_blocks(p)), 2)
+        p += "]. [[prop:vumpus]]"
+        blocks = [('prop', 'vumpus'), ('prop', 'zumpus'),
+                  ('axiom', "(vumpus 'x) -> (zumpus 'x)")]
+        self.assertEqual(ce.get_verified_blocks(p), blocks)
+
+        # A prefix that does not extend the last one is scanned from scratch.
+        self.assertEqual(ce.get_verified_blocks('[[object:sally]] [[prop:zumpus'),
+                         [('object', 'sally')])
+        self.assertEqual(ce.get_verified_blocks(p), blocks)
+
+        # Growing one character at a time gives the same blocks as scanning
+        # each prefix from scratch (shrinking prefixes always rescan).
+        growing = [ce.get_verified_blocks(p[:i]) for i in range(len(p) + 1)]
+        shrinking = [ce.get_verified_blocks(p[:i]) for i in range(len(p), -1, -1)]
+        self.assertEqual(growing, shrinking[::-1])
+
+    def test_regex_not_containing(self):
+        r = regex.compile(regex_not_containing('[[') + regex.escape('[['))
+
+        self.assertTrue(r.fullmatch('a [b] [c [['))
+        self.assertTrue(r.fullmatch('[['))
+        self.assertFalse(r.fullmatch('a [[b [['))
+        self.assertTrue(r.match('a [b [', partial=True).partial)
+        # Stops at the first marker.
+        self.assertEqual(r.match('a [[b [[').group(), 'a [[')
+
+    def test_trie_regex(self):
+        # One choice is a prefix of another.
+        r = regex.compile(f'(?:{_trie_regex(["ab", "abc", "b(c)"])})\\]\\]')
+
+        for s in ('ab]]', 'abc]]', 'b(c)]]'):
+            self.assertTrue(r.fullmatch(s))
+        for s in ('a]]', 'abcc]]', 'ac]]', 'b]]', ']]'):
+            self.assertFalse(r.fullmatch(s))
+
+        self.assertTrue(r.match('ab', partial=True).partial)
+        self.assertTrue(r.match('abc]', partial=True).partial)
+        self.assertTrue(r.match('b(', partial=True).partial)
+        self.assertIsNone(r.match('abd', partial=True))
+
     def test_algebra_problem(self):
         import tactics
 
@@ -517,36 +890,25 @@ Answer: 53'''
 
 
     def test_no_valid_tokens_bug(self):
-        d = domain.FirstOrderLogicDomain()
-        prob = d.start_derivation()
-
-        ce = PeanoCompletionEngine(d, prob)
+        ce = self._fol_engine()
 
         prefix = """Formalized context: 1- [[prop:vumpus]] are [[prop:zumpus]]. [[axiom:(vumpus 'x) -> (zumpus 'x)]]. 2- Each [[prop:zumpus]] is a [[prop:rompus]]. [[axiom:(zumpus 'x) -> (rompus 'x)]]. 3- Every [[prop:tumpus]] is [[prop:small]]. [[axiom:(tumpus 'x) -> (small 'x)]]. 4- Each [[prop:impus]] is a [[prop:tumpus]]. [[axiom:(impus 'x) -> (tumpus 'x)]]. 5- Each [[prop:rompus]] is a [[prop:jompus]]. [[axiom:(rompus 'x) -> (jompus 'x)]]. 6- [[prop:tumpus]] are [[prop:wumpus]]. [[axiom:(tumpus 'x) -> (wumpus 'x)]]. 7- Every [[prop:yumpus]] is [[prop:transparent]]. [[axiom:(yumpus 'x) -> (transparent 'x)]]. 8- [[prop:yumpus]] are [[prop:numpus]]. [[axiom:(yumpus 'x) -> (numpus 'x)]]. 9- [[prop:zumpus]] are [[prop:orange]]. [[axiom:(zumpus 'x) -> (orange 'x)]]. 10- [[prop:jompus]] are [[prop:yumpus]]. [[axiom:(jompus 'x) -> (yumpus 'x)]]. 11- [[prop:rompus]] are [[prop:floral]]. [[axiom:(rompus 'x) -> (floral 'x)]]. 12- [[prop:wumpus]] are [[prop:vumpus]]. [[axiom:(wumpus 'x) -> (vumpus 'x)]]. 13- Every [[prop:wumpus]] is [[prop:nervous]]. [[axiom:(wumpus 'x) -> (nervous 'x)]]. 14- Every [[prop:impus]] is [[prop:temperate]]. [[axiom:(impus 'x) -> (temperate 'x)]]. 15- [[prop:jompus]] are not [[prop:sweet]]. [[axiom:(jompus 'x) -> (not (sweet 'x))]]. 16- [[prop:dumpus]] are not [[prop:floral]]. [[axiom:(dumpus 'x) -> (not (floral 'x))]]. 17- Every [[prop:vumpus]] is [[prop:angry]]. [[axiom:(vumpus 'x) -> (angry 'x)]]. 18- [[object:fae]] is a [[prop:vumpus]]. [[axiom:(vumpus fae)]].\nFormalized goal: [[goal:(not (floral fae))]]\nReasoning: [[infer:(angry fae)]] Fae is angry. [[infer:(zumpus fae)]] Fae is a zumpus. [[infer:(orange fae)]] Fae is orange. [[infer:("""
 
-        from transformers import AutoTokenizer
-        tokenizer = AutoTokenizer.from_pretrained("facebook/opt-13b", use_fast=False)
-
-        vocab = [tokenizer.decode([i]) for i in range(tokenizer.vocab_size)]
+        _, vocab = _get_tokenizer_and_vocab("facebook/opt-13b")
 
         csd = StreamingCSD(ce, vocab)
 
-        tokens = tokenizer.encode(prefix)
+        tokens = _encoded(prefix)
 
-        for t in tokens:
-            assert csd.can_token_follow(t)
-            csd.feed_prediction(t)
+        self._feed_tokens(csd, tokens)
 
         # Only inference possible at this point is '(rompus fae)'
-        # We remove the first token because encode with the OPT tokenizer
-        # always prepends a 'start of sentence' token.
-        assert csd.get_valid_tokens() == tokenizer.encode('rom')[1:]
+        # Special tokens are left out because the OPT tokenizer would
+        # otherwise prepend a 'start of sentence' token.
+        assert tuple(csd.get_valid_tokens()) == _encoded('rom', add_special_tokens=False)
 
     def test_closing_token_bug(self):
-        d = domain.FirstOrderLogicDomain()
-        prob = d.start_derivation()
-
-        ce = PeanoCompletionEngine(d, prob)
+        ce = self._fol_engine()
 
         prefix = """Formalized context: 1- [[prop:vumpus]] are [[prop:luminous]].
         [[axiom:(vumpus 'x) -> (luminous 'x)]].
@@ -554,25 +916,20 @@ Answer: 53'''
         3- Every [[prop:jompus]] is not [[prop:luminous]].
            [[axiom:(jompus 'x) -> (not (luminous 'x))"""
 
-        from transformers import AutoTokenizer
-        tokenizer = AutoTokenizer.from_pretrained("facebook/opt-13b", use_fast=False)
-
-        vocab = [tokenizer.decode([i]) for i in range(tokenizer.vocab_size)]
+        _, vocab = _get_tokenizer_and_vocab("facebook/opt-13b")
 
         csd = StreamingCSD(ce, vocab)
 
-        tokens = tokenizer.encode(prefix)
+        tokens = _encoded(prefix)
 
-        for t in tokens:
-            assert csd.can_token_follow(t)
-            csd.feed_prediction(t)
+        self._feed_tokens(csd, tokens)
 
         valid_tokens = csd.get_valid_tokens()
         # Here, the only valid possibilities are: ' ->' (continuing with an implication)
         # or ]] (finishing the axiom right away).
         assert len(valid_tokens) == 2
-        assert tokenizer.encode(' ->')[1] in valid_tokens
-        assert tokenizer.encode(']]')[1] in valid_tokens
+        assert _encoded(' ->', add_special_tokens=False)[0] in valid_tokens
+        assert _encoded(']]', add_special_tokens=False)[0] in valid_tokens
 
     def test_proofwriter_prompt_example1(self):
         examples = [("""Formalized context: 1- [[object:anne]] is [[prop:furry]]. [[axiom:(furry anne)]]. 2- [[object:anne]] is not [[prop:young]]. [[axiom:(not (young anne))]]. 3- [[object:gary]] is [[prop:round]]. [[axiom:(round gary)]]. 4- All [[prop:furry]] people are [[prop:round]]. [[axiom:(furry 'x) -> (round 'x)]] 5- [[prop:quiet]] people are not [[prop:furry]]. [[axiom:(quiet 'x) -> (not (furry 'x))]]. 6- [[prop:blue]], [[prop:big]] people are not [[prop:young]]. [[axiom:(blue 'x) -> (big 'x) -> (not (young 'x))]]. 7- If [[object:anne]] is [[prop:round]] then [[object:anne]] is [[prop:blue]]. [[axiom:(round anne) -> (blue anne)]]. 8- If something is [[prop:blue]] and [[prop:round]] then it is not [[prop:big]]. [[axiom:(blue 'x) -> (round 'x) -> (not (big 'x))]]
@@ -587,23 +944,14 @@ Reasoning: [[infer:(sees mouse mouse)]] The mouse sees the mouse. [[infer:(likes
 Answer: True""", True)]
 
         for solution, answer in examples:
-            d = domain.FirstOrderLogicDomain()
-            prob = d.start_derivation()
-
-            ce = PeanoCompletionEngine(d, prob)
-            from transformers import AutoTokenizer
-            tokenizer = AutoTokenizer.from_pretrained("facebook/opt-13b", use_fast=False)
-
-            vocab = [tokenizer.decode([i]) for i in range(tokenizer.vocab_size)]
+            ce = self._fol_engine()
+            _, vocab = _get_tokenizer_and_vocab("facebook/opt-13b")
 
             csd = StreamingCSD(ce, vocab)
 
-            tokens = tokenizer.encode(solution)
+            tokens = _encoded(solution)
 
-            for i, t in enumerate(tokens):
-                if not csd.can_token_follow(t):
-                    breakpoint()
-                csd.feed_prediction(t)
+            self._feed_tokens(csd, tokens)
 
             done, prediction = ce.is_complete(solution)
 
@@ -618,23 +966,14 @@ Answer: True""", True)]
         Answer (Yes or no): Yes, it is obligatory for Carol to suggest an alternative time for the charity gala.
         """
 
-        d = domain.FirstOrderLogicDomain()
-        prob = d.start_derivation()
-
-        ce = PeanoCompletionEngine(d, prob)
-        from transformers import AutoTokenizer
-        tokenizer = AutoTokenizer.from_pretrained("facebook/opt-13b", use_fast=False)
-
-        vocab = [tokenizer.decode([i]) for i in range(tokenizer.vocab_size)]
+        ce = self._fol_engine()
+        _, vocab = _get_tokenizer_and_vocab("facebook/opt-13b")
 
         csd = StreamingCSD(ce, vocab)
 
-        tokens = tokenizer.encode(solution)
+        tokens = _encoded(solution)
 
-        for i, t in enumerate(tokens):
-            if not csd.can_token_follow(t):
-                breakpoint()
-            csd.feed_prediction(t)
+        self._feed_tokens(csd, tokens)
 
         done, prediction = ce.is_complete(solution)
 
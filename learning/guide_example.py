@@ -28,6 +28,13 @@ class CountingGuide:
         self.start_marker = start_marker
         self.end_marker = end_marker
 
+        # complete() is called for every token the model generates, so
+        # compile each pattern only once.
+        self._outside_block_regex = regex.compile(
+            completion.regex_not_containing(start_marker) + regex.escape(start_marker))
+        # Pattern for the i-th guided block, keyed by i.
+        self._block_regex = {}
+
     def complete(self, prefix: str):
         if not prefix.endswith(self.start_marker):
             # We're outside a guided block. Let the model generate anything
@@ -35,8 +42,7 @@ class CountingGuide:
             # Note that now we only need to worry about what happens once the
             # model has generated something ending with the start marker.
             # because of the contract between Synchromesh and completion engines.
-            return regex.compile(completion.regex_not_containing(self.start_marker) +
-                                 regex.escape(self.start_marker))
+            return self._outside_block_regex
 
         # We're in a newly open guided block.
         # Let's first count how many previous guided blocks were there:
@@ -44,8 +50,14 @@ class CountingGuide:
 
         # Only let the model return the next correct number, followed by the
         # end marker.
-        return regex.compile(str(self.starting_number + self.step_size * i) +
-                             regex.escape(self.end_marker))
+        block_regex = self._block_regex.get(i)
+
+        if block_regex is None:
+            block_regex = regex.compile(str(self.starting_number + self.step_size * i) +
+                                        regex.escape(self.end_marker))
+            self._block_regex[i] = block_regex
+
+        return block_regex
 
     def is_complete(self, prefix: str) -> bool:
         # Here we decide when the model is done with its response.